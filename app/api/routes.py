@@ -1,17 +1,28 @@
 """
 APIルートの定義
 """
+import asyncio
+import hashlib
 from typing import List, Optional, Dict, Any
+import httpx
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 
 from app.services.openai_service import openai_service
 from app.services.jancode_service import jancode_service
+from app.services.cache_service import AsyncTTLCache
 from app.utils.jancode_utils import validate_jancode
 from app.core.config import settings
 
 router = APIRouter()
 
+# 推定結果のキャッシュ（モデルの変更時に無効化されるようモデル名で分割）
+estimation_cache = AsyncTTLCache(
+    namespace=f"estimate:{settings.OPENAI_MODEL}",
+    maxsize=settings.ESTIMATION_CACHE_MAXSIZE,
+    ttl=settings.ESTIMATION_CACHE_TTL
+)
+
 class JANCodeRequest(BaseModel):
     """JANコード推定リクエストモデル"""
     product_name: str
@@ -41,6 +52,9 @@ class JANCodeResponse(BaseModel):
     usedKeywords: List[str] = []  # 検索に使用したキーワードのリスト
     keywordHits: Dict[str, int] = {}  # 各キーワードに対するヒット数
 
+# ProductInfoのフィールド名（検証済みの商品情報からモデルを構築する際に使用）
+_PRODUCT_FIELDS = tuple(ProductInfo.model_fields)
+
 @router.post("/estimate-jancode", response_model=JANCodeResponse)
 async def estimate_jancode(request: JANCodeRequest):
     """
@@ -61,189 +75,407 @@ async def estimate_jancode(request: JANCodeRequest):
         if not product_image_url:
             raise HTTPException(status_code=400, detail="画像URLが空です")
         
-        # ステップ1: 商品画像と商品名から検索キーワード候補を生成
-        search_keywords = await openai_service.generate_search_keywords(
-            image_url=product_image_url,
-            product_name=product_name
+        # 商品画像は一度だけダウンロードし、以降の各ステップで使い回す
+        try:
+            image_b64 = await openai_service.fetch_image_base64(product_image_url)
+        except httpx.HTTPError:
+            # ダウンロードに失敗した場合は各ステップのエラー処理に委ねる
+            image_b64 = None
+        
+        # 同一の画像と商品名による推定結果はキャッシュから返す
+        cache_key = None
+        image_hash = None
+        if image_b64:
+            # 画像のハッシュは一度だけ計算し、キーワード生成のキャッシュにも使い回す
+            image_hash = hashlib.sha256(image_b64.encode()).hexdigest()
+            cache_key = estimation_cache.make_key(image_hash, product_name)
+            cached_response = await estimation_cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+        
+        response = await _estimate_jancode(
+            product_name=product_name,
+            product_image_url=product_image_url,
+            image_b64=image_b64,
+            image_hash=image_hash
         )
         
-        # 検索キーワードが生成できなかった場合
-        if not search_keywords:
-            return JANCodeResponse(
-                candidates=[],
-                confidence=0.0,
-                product_name=product_name,
-                message="検索キーワードを生成できませんでした。より詳細な商品情報や鮮明な画像を提供してください。"
-            )
+        # 候補が得られた場合のみキャッシュに保存
+        if cache_key and response.candidates:
+            await estimation_cache.set(cache_key, response.model_dump())
         
-        # ステップ2: 各キーワードでJANCODE LOOKUP APIを呼び出し
-        all_products = []
-        keyword_hits = {}  # 各キーワードに対するヒット数
-        keyword_product_map = {}  # 各商品がどのキーワードで見つかったかを記録
-        
-        for keyword in search_keywords:
-            try:
-                search_result = await jancode_service.search_by_keyword(
-                    keyword=keyword,
-                    hits=3,  # 各キーワードで最大3件取得
-                    page=1
-                )
-                
-                # ヒット数を記録
-                hit_count = search_result.get("info", {}).get("count", 0)
-                keyword_hits[keyword] = hit_count
-                
-                # 検索結果から商品情報を取得
-                products = search_result.get("product", [])
-                if products:
-                    # 各商品に検索キーワードを記録
-                    for product in products:
-                        code_number = product.get("codeNumber")
-                        if code_number:
-                            if code_number not in keyword_product_map:
-                                keyword_product_map[code_number] = []
-                            keyword_product_map[code_number].append(keyword)
-                    
-                    all_products.extend(products)
-            except Exception as e:
-                # 検索エラーは無視して次のキーワードに進む
-                keyword_hits[keyword] = 0
-                continue
+        return response
         
-        # 重複するJANコードを削除
-        unique_products = {}
-        for product in all_products:
-            code_number = product.get("codeNumber")
-            if code_number and code_number not in unique_products:
-                # 商品情報に検索キーワードを追加
-                if code_number in keyword_product_map:
-                    product["searchKeyword"] = ", ".join(keyword_product_map[code_number])
-                unique_products[code_number] = product
-        
-        # 候補がない場合
-        if not unique_products:
-            # 画像分析によるJANコード候補の推定（フォールバック）
-            image_candidates = await openai_service.analyze_product_image(
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"エラーが発生しました: {str(e)}")
+
+async def _estimate_jancode(product_name: str,
+                            product_image_url: str,
+                            image_b64: Optional[str],
+                            image_hash: Optional[str] = None) -> JANCodeResponse:
+    """
+    JANコード推定の各ステップ（キーワード生成・検索・絞り込み）を実行する
+    
+    Args:
+        product_name: 商品名
+        product_image_url: 商品画像のURL
+        image_b64: Base64エンコード済みの商品画像（ダウンロード失敗時はNone）
+        image_hash: image_b64のSHA-256ハッシュ（キャッシュキーに使用）
+        
+    Returns:
+        JANCodeResponse: 推定されたJANコード情報
+    """
+    # 画像のダウンロードに失敗した場合は、同じURLを再度ダウンロードしないよう画像を使うステップを省略する
+    has_image = image_b64 is not None
+    
+    # 画像に写っているJANコードの読み取りを投機的に開始する（追加のトークンを消費するため設定で無効化可能）
+    image_task = None
+    if settings.SPECULATIVE_IMAGE_ANALYSIS and has_image:
+        image_task = asyncio.create_task(
+            openai_service.analyze_product_image(
+                image_url=product_image_url,
+                product_name=product_name,
+                image_b64=image_b64
+            )
+        )
+    
+    # ステップ1: 商品画像と商品名から検索キーワード候補と商品の外観の説明を生成
+    try:
+        if has_image:
+            search_keywords, visual_description = await openai_service.generate_search_keywords(
                 image_url=product_image_url,
-                product_name=product_name
+                product_name=product_name,
+                image_b64=image_b64,
+                image_hash=image_hash
             )
-            
-            if not image_candidates:
-                return JANCodeResponse(
-                    candidates=[],
-                    confidence=0.0,
+        else:
+            # 画像がない場合は商品名のみで検索する
+            search_keywords, visual_description = ([product_name] if product_name else []), ""
+    except BaseException:
+        # エラーやクライアントの切断（CancelledError）時は投機的な画像分析も止める
+        if image_task and not image_task.done():
+            image_task.cancel()
+        raise
+    
+    # 重複するキーワードで同じ検索を二重に実行しないよう除外（順序は維持）
+    search_keywords = list(dict.fromkeys(search_keywords))
+    
+    # 検索キーワードが生成できず、画像からの読み取りも行わない場合
+    if not search_keywords and not image_task:
+        return _no_keywords_response(product_name)
+    
+    # ステップ2: 各キーワードでJANCODE LOOKUP APIを呼び出し（画像分析の完了を待たずに開始）
+    unique_products: Dict[str, Dict[str, Any]] = {}  # JANコードごとの商品情報（重複なし）
+    keyword_hits = {}  # 各キーワードに対するヒット数
+    keyword_product_map: Dict[str, List[str]] = {}  # 各商品がどのキーワードで見つかったかを記録
+    
+    search_task = asyncio.create_task(
+        jancode_service.search_by_keywords(
+            keywords=search_keywords,
+            hits=3,  # 各キーワードで最大3件取得
+            page=1
+        )
+    )
+    image_candidates: Optional[List[str]] = None
+    try:
+        if image_task:
+            # 画像分析がキーワード検索より先に終われば、読み取ったJANコードを確認する
+            await asyncio.wait({image_task, search_task}, return_when=asyncio.FIRST_COMPLETED)
+            if image_task.done():
+                image_candidates = await _await_image_candidates(image_task)
+                scanned_product = await _lookup_scanned_jancode(
+                    image_candidates,
                     product_name=product_name,
-                    message="JANコードを推定できませんでした。より詳細な商品情報や鮮明な画像を提供してください。"
+                    search_keywords=search_keywords
                 )
-            
-            # JANコードのみを持つ簡易的な商品情報オブジェクトを作成
-            candidate_products = []
-            for jancode in image_candidates[:max(3, settings.MAX_CANDIDATES)]:  # 最低3つ、最大はMAX_CANDIDATES
-                candidate_products.append(
-                    ProductInfo(
-                        codeNumber=jancode,
-                        itemName=f"{product_name} (推定)",
-                        codeType="JAN (推定)"
-                    )
-                )
-            
-            return JANCodeResponse(
-                candidates=candidate_products,
-                confidence=0.3,  # 低い確信度
+                if scanned_product:
+                    search_task.cancel()
+                    return _scanned_response(scanned_product, product_name, search_keywords)
+        
+        search_results = await search_task
+    except BaseException:
+        # エラーやクライアントの切断（CancelledError）時は実行中のタスクを止める
+        for task in (image_task, search_task):
+            if task and not task.done():
+                task.cancel()
+        raise
+    
+    # 検索エラーとなったキーワードは空の結果（ヒット数0）として返される
+    for keyword, search_result in search_results.items():
+        # ヒット数を記録
+        hit_count = search_result.get("info", {}).get("count", 0)
+        keyword_hits[keyword] = hit_count
+        
+        # 検索結果の商品情報を重複を除きながら記録
+        for product in search_result.get("product", []):
+            code_number = product.get("codeNumber")
+            if not code_number:
+                continue
+            keyword_product_map.setdefault(code_number, []).append(keyword)
+            # 検索結果はキャッシュと共有されるためコピーして保持する
+            unique_products.setdefault(code_number, dict(product))
+    
+    # 商品情報に検索キーワードを追加
+    for code_number, product in unique_products.items():
+        product["searchKeyword"] = ", ".join(keyword_product_map[code_number])
+    
+    if unique_products and image_task and not image_task.done():
+        # キーワード検索で候補が得られたため、未完了の投機的な画像分析は中止する
+        image_task.cancel()
+    
+    # 候補がない場合
+    if not unique_products:
+        if image_task and image_candidates is None:
+            # キーワード検索より後に終わった画像分析の結果で、読み取ったJANコードを確認する
+            image_candidates = await _await_image_candidates(image_task)
+            scanned_product = await _lookup_scanned_jancode(
+                image_candidates,
                 product_name=product_name,
-                message="JANコード候補を推定しましたが、確度は低いです。JANCODE LOOKUP APIで商品情報が見つかりませんでした。",
-                usedKeywords=search_keywords,
-                keywordHits=keyword_hits
+                search_keywords=search_keywords
             )
+            if scanned_product:
+                return _scanned_response(scanned_product, product_name, search_keywords)
         
-        # ステップ3: 得られたJANコード候補を再度OpenAI APIで絞り込み
-        product_list = list(unique_products.values())
-        filtered_jancodes = await openai_service.filter_jancode_candidates(
-            jancode_candidates=product_list,
-            product_name=product_name,
-            image_url=product_image_url
-        )
+        # 検索キーワードが生成できなかった場合
+        if not search_keywords:
+            return _no_keywords_response(product_name)
         
-        # 候補がない場合
-        if not filtered_jancodes:
-            # 元の候補をそのまま使用
-            filtered_jancodes = list(unique_products.keys())
+        # 画像分析によるJANコード候補の推定（フォールバック、投機的に実行済みの場合はその結果を使用）
+        if image_candidates is None and has_image:
+            image_candidates = await openai_service.analyze_product_image(
+                image_url=product_image_url,
+                product_name=product_name,
+                image_b64=image_b64
+            )
         
-        # 候補の商品情報を取得
-        candidate_products = []
+        if not image_candidates:
+            return JANCodeResponse.model_construct(
+                candidates=[],
+                confidence=0.0,
+                product_name=product_name,
+                message="JANコードを推定できませんでした。より詳細な商品情報や鮮明な画像を提供してください。"
+            )
         
-        # 絞り込まれた候補の商品情報を追加
-        for jancode in filtered_jancodes:
-            if jancode in unique_products:
-                candidate_products.append(unique_products[jancode])
-            else:
-                # JANコードが見つからない場合は、簡易的な商品情報を作成
-                candidate_products.append({
-                    "codeNumber": jancode,
-                    "codeType": "JAN (推定)",
-                    "itemName": f"{product_name} (推定)"
-                })
-        
-        # 候補が3つ未満の場合、元の候補から追加
-        if len(candidate_products) < 3 and len(product_list) > len(candidate_products):
-            # 既に候補に含まれていないJANコードを抽出
-            existing_jancodes = {product.get("codeNumber") for product in candidate_products}
-            additional_products = [
-                product for product in product_list
-                if product.get("codeNumber") not in existing_jancodes
-            ]
-            
-            # 必要な数だけ追加（最低3つになるまで）
-            needed = 3 - len(candidate_products)
-            candidate_products.extend(additional_products[:needed])
-        
-        # 最も可能性の高い候補
-        primary_candidate = filtered_jancodes[0] if filtered_jancodes else None
-        
-        # 商品情報を取得
-        product_info = unique_products.get(primary_candidate, {}) if primary_candidate else {}
-        
-        # ProductInfoモデルに変換
-        candidate_product_models = []
-        for product in candidate_products:
-            candidate_product_models.append(
-                ProductInfo(
-                    codeNumber=product.get("codeNumber", ""),
-                    codeType=product.get("codeType"),
-                    itemName=product.get("itemName"),
-                    itemModel=product.get("itemModel"),
-                    itemUrl=product.get("itemUrl"),
-                    itemImageUrl=product.get("itemImageUrl"),
-                    brandName=product.get("brandName"),
-                    makerName=product.get("makerName"),
-                    makerNameKana=product.get("makerNameKana"),
-                    ProductDetails=product.get("ProductDetails", []),
-                    searchKeyword=product.get("searchKeyword")
+        # JANコードのみを持つ簡易的な商品情報オブジェクトを作成
+        candidate_products = []
+        for jancode in image_candidates[:max(3, settings.MAX_CANDIDATES)]:  # 最低3つ、最大はMAX_CANDIDATES
+            candidate_products.append(
+                ProductInfo.model_construct(
+                    codeNumber=jancode,
+                    itemName=f"{product_name} (推定)",
+                    codeType="JAN (推定)"
                 )
             )
         
-        # レスポンスを作成
-        if primary_candidate and product_info:
-            confidence = 0.9  # 高い確信度
-            return JANCodeResponse(
-                jancode=primary_candidate,
-                candidates=candidate_product_models,
-                confidence=confidence,
-                product_name=product_info.get("itemName", product_name),
-                message="JANコードが正常に推定されました。",
-                usedKeywords=search_keywords,
-                keywordHits=keyword_hits
-            )
+        return JANCodeResponse.model_construct(
+            candidates=candidate_products,
+            confidence=0.3,  # 低い確信度
+            product_name=product_name,
+            message="JANコード候補を推定しましたが、確度は低いです。JANCODE LOOKUP APIで商品情報が見つかりませんでした。",
+            usedKeywords=search_keywords,
+            keywordHits=keyword_hits
+        )
+    
+    # ステップ3: 得られたJANコード候補を再度OpenAI APIで絞り込み（テキストのみ）
+    filtered_jancodes = await openai_service.filter_jancode_candidates(
+        jancode_candidates=list(unique_products.values()),
+        product_name=product_name,
+        visual_description=visual_description
+    )
+    
+    # 候補がない場合
+    if not filtered_jancodes:
+        # 元の候補をそのまま使用
+        filtered_jancodes = list(unique_products.keys())
+    
+    # 候補の商品情報を取得
+    candidate_products = []
+    
+    # 絞り込まれた候補の商品情報を追加
+    for jancode in filtered_jancodes:
+        if jancode in unique_products:
+            candidate_products.append(unique_products[jancode])
+        else:
+            # JANコードが見つからない場合は、簡易的な商品情報を作成
+            candidate_products.append({
+                "codeNumber": jancode,
+                "codeType": "JAN (推定)",
+                "itemName": f"{product_name} (推定)"
+            })
+    
+    # 候補が3つ未満の場合、元の候補から追加
+    if len(candidate_products) < 3 and len(unique_products) > len(candidate_products):
+        # 既に候補に含まれていないJANコードを抽出
+        additional_products = [
+            product for code_number, product in unique_products.items()
+            if code_number not in filtered_jancodes
+        ]
         
-        # 商品情報が見つからなかった場合
-        return JANCodeResponse(
+        # 必要な数だけ追加（最低3つになるまで）
+        needed = 3 - len(candidate_products)
+        candidate_products.extend(additional_products[:needed])
+    
+    # 最も可能性の高い候補
+    primary_candidate = filtered_jancodes[0] if filtered_jancodes else None
+    
+    # 商品情報を取得
+    product_info = unique_products.get(primary_candidate, {}) if primary_candidate else {}
+    
+    # ProductInfoモデルに変換
+    candidate_product_models = []
+    for product in candidate_products:
+        candidate_product_models.append(_to_product_info(product))
+    
+    # レスポンスを作成
+    if primary_candidate and product_info:
+        confidence = 0.9  # 高い確信度
+        return JANCodeResponse.model_construct(
+            jancode=primary_candidate,
             candidates=candidate_product_models,
-            confidence=0.7,  # 中程度の確信度
-            product_name=product_name,
-            message="複数のJANコード候補が見つかりました。最も可能性の高い候補から順に表示しています。",
+            confidence=confidence,
+            product_name=product_info.get("itemName", product_name),
+            message="JANコードが正常に推定されました。",
             usedKeywords=search_keywords,
             keywordHits=keyword_hits
         )
+    
+    # 商品情報が見つからなかった場合
+    return JANCodeResponse.model_construct(
+        candidates=candidate_product_models,
+        confidence=0.7,  # 中程度の確信度
+        product_name=product_name,
+        message="複数のJANコード候補が見つかりました。最も可能性の高い候補から順に表示しています。",
+        usedKeywords=search_keywords,
+        keywordHits=keyword_hits
+    )
+
+async def _await_image_candidates(image_task: "asyncio.Task[List[str]]") -> List[str]:
+    """
+    投機的に実行した画像分析の結果を取得する
+    
+    Args:
+        image_task: analyze_product_imageを実行しているタスク
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"エラーが発生しました: {str(e)}")
\ No newline at end of file
+    Returns:
+        List[str]: 画像分析で得られたJANコード候補のリスト（失敗した場合は空のリスト）
+    """
+    try:
+        return await image_task
+    except Exception:
+        # 画像分析の失敗はキーワード検索の妨げにしない
+        return []
+
+def _scanned_response(scanned_product: Dict[str, Any],
+                      product_name: str,
+                      search_keywords: List[str]) -> JANCodeResponse:
+    """
+    画像から読み取ったJANコードで見つかった商品のレスポンスを作成する
+    
+    Args:
+        scanned_product: 見つかった商品情報
+        product_name: 商品名
+        search_keywords: 生成された検索キーワードのリスト
+        
+    Returns:
+        JANCodeResponse: 推定されたJANコード情報
+    """
+    return JANCodeResponse.model_construct(
+        jancode=scanned_product["codeNumber"],
+        candidates=[_to_product_info(scanned_product)],
+        confidence=0.95,  # 非常に高い確信度
+        product_name=scanned_product.get("itemName") or product_name,
+        message="商品画像から読み取ったJANコードで商品情報が見つかりました。",
+        usedKeywords=search_keywords
+    )
+
+def _no_keywords_response(product_name: str) -> JANCodeResponse:
+    """
+    検索キーワードが生成できなかった場合のレスポンスを作成する
+    
+    Args:
+        product_name: 商品名
+        
+    Returns:
+        JANCodeResponse: 候補なしのレスポンス
+    """
+    return JANCodeResponse.model_construct(
+        candidates=[],
+        confidence=0.0,
+        product_name=product_name,
+        message="検索キーワードを生成できませんでした。より詳細な商品情報や鮮明な画像を提供してください。"
+    )
+
+async def _lookup_scanned_jancode(image_candidates: List[str],
+                                  product_name: str,
+                                  search_keywords: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    画像から読み取ったJANコード候補のうち、チェックディジットが正しい最初のコードで商品を検索する
+    
+    Args:
+        image_candidates: 画像分析で得られたJANコード候補のリスト
+        product_name: 商品名
+        search_keywords: 生成された検索キーワードのリスト
+        
+    Returns:
+        Optional[Dict[str, Any]]: 見つかった商品情報（有効なコードがない、見つからない、
+                                  または商品名・検索キーワードと無関係な商品の場合はNone）
+    """
+    jancode = next((code for code in image_candidates if validate_jancode(code)), None)
+    if not jancode:
+        return None
+    
+    try:
+        search_result = await jancode_service.search_by_code(jancode)
+    except Exception:
+        # 検索エラーの場合は通常のキーワード検索に進む
+        return None
+    
+    products = search_result.get("product", [])
+    if not products or not products[0].get("codeNumber"):
+        return None
+    
+    # 偶然チェックディジットが一致した無関係な商品を返さないよう、商品名との関連を確認する
+    product = products[0]
+    return product if _is_related_product(product, [product_name] + search_keywords) else None
+
+def _is_related_product(product: Dict[str, Any], terms: List[str]) -> bool:
+    """
+    商品情報の商品名・ブランド名・メーカー名が、商品名や検索キーワードと重なるかを判定する
+    
+    Args:
+        product: JANCODE LOOKUP APIの商品情報
+        terms: 商品名や検索キーワードのリスト
+        
+    Returns:
+        bool: いずれかの語が重なる場合はTrue
+    """
+    names = [
+        product.get(field) for field in ("itemName", "brandName", "makerName")
+        if isinstance(product.get(field), str) and product.get(field)
+    ]
+    terms = [term for term in terms if isinstance(term, str) and term]
+    # 検索キーワードは空白区切りの複数語からなるため、2文字以上の語に分けて比較する
+    words = {word for term in terms for word in term.split() if len(word) >= 2}
+    
+    return (
+        any(word in name for word in words for name in names)
+        or any(name in term for name in names for term in terms)
+    )
+
+def _to_product_info(product: Dict[str, Any]) -> ProductInfo:
+    """
+    JANCODE LOOKUP APIの商品情報をProductInfoモデルに変換する
+    
+    商品情報はJANCODE LOOKUP APIから取得したもの、または内部で作成したものに限られるため、
+    検証を省略してモデルを構築する
+    
+    Args:
+        product: 商品情報
+        
+    Returns:
+        ProductInfo: 変換された商品情報モデル
+    """
+    fields = {field: product.get(field) for field in _PRODUCT_FIELDS}
+    fields["codeNumber"] = product.get("codeNumber", "")
+    fields["ProductDetails"] = product.get("ProductDetails", [])
+    return ProductInfo.model_construct(**fields)
\ No newline at end of file
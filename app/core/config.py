@@ -10,12 +10,38 @@ class Settings:
     
     # OpenAI API設定
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
+    OPENAI_MODEL: str = "gpt-4o-mini"  # 画像分析に使用するモデル
+    OPENAI_TIMEOUT: float = 60.0  # OpenAI APIのタイムアウト（秒）
+    MAX_OPENAI_CONCURRENCY: int = int(os.getenv("MAX_OPENAI_CONCURRENCY", "8"))  # 最大同時リクエスト数
+    OPENAI_RETRY_ATTEMPTS: int = 3  # 一時的なエラー（レート制限・接続エラー・5xxなど）時の最大試行回数
     
     # JANCODE LOOKUP API設定
     JANCODE_API_URL: str = "https://api.jancodelookup.com/"
     JANCODE_API_APP_ID: str = os.getenv("JANCODE_API_APP_ID", "")
     
+    # 外部API呼び出し用HTTPクライアント設定
+    HTTP_TIMEOUT: float = 15.0  # タイムアウト（秒）
+    HTTP_MAX_CONNECTIONS: int = 100  # 最大同時接続数
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 50  # 最大キープアライブ接続数
+    
+    # 画像設定（OpenAI APIへ送信する前に縮小・再エンコードする）
+    IMAGE_MAX_SIZE: int = 1024  # 長辺の最大ピクセル数
+    IMAGE_JPEG_QUALITY: int = 80  # JPEG品質
+    
     # JANコード推定設定
     MAX_CANDIDATES: int = 5  # 最大候補数
+    # キーワード生成と並行して画像からのJANコード読み取りを行うか（追加のトークンを消費する）
+    SPECULATIVE_IMAGE_ANALYSIS: bool = os.getenv("SPECULATIVE_IMAGE_ANALYSIS", "true").lower() == "true"
+    
+    # キャッシュ設定
+    REDIS_URL: str = os.getenv("REDIS_URL", "")  # 設定時はワーカー間でキャッシュを共有する（例: redis://localhost:6379/0）
+    REDIS_TIMEOUT: float = 0.3  # Redisの接続・応答タイムアウト（秒、超過時はインメモリのみで処理を続ける）
+    REDIS_RETRY_INTERVAL: float = 30.0  # Redisでエラーが発生した後、再接続を試みるまでRedisを使わない期間（秒）
+    ESTIMATION_CACHE_MAXSIZE: int = 10000  # 推定結果のキャッシュ最大件数
+    ESTIMATION_CACHE_TTL: int = 3600  # 推定結果のキャッシュ有効期間（秒）
+    KEYWORD_SEARCH_CACHE_MAXSIZE: int = 5000  # キーワード検索結果のキャッシュ最大件数
+    KEYWORD_SEARCH_CACHE_TTL: int = 3600  # キーワード検索結果のキャッシュ有効期間（秒）
+    OPENAI_CACHE_MAXSIZE: int = 5000  # OpenAI APIの生成結果のキャッシュ最大件数
+    OPENAI_CACHE_TTL: int = 86400  # OpenAI APIの生成結果のキャッシュ有効期間（秒）
 
 settings = Settings()
\ No newline at end of file
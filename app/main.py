@@ -1,17 +1,23 @@
 """
 FastAPIアプリケーションのエントリーポイント
 """
+import httpx
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+from redis.asyncio import Redis
 
 from app.core.config import settings
 from app.api.routes import router as api_router
+from app.services.jancode_service import jancode_service
+from app.services.openai_service import openai_service
+from app.services.cache_service import set_redis_client
 
 # FastAPIアプリケーションの作成
 app = FastAPI(
     title=settings.PROJECT_NAME,
-    openapi_url=f"{settings.API_V1_STR}/openapi.json"
+    openapi_url=f"{settings.API_V1_STR}/openapi.json",
+    default_response_class=ORJSONResponse
 )
 
 # CORSミドルウェアの設定
@@ -23,13 +29,47 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup():
+    """
+    外部API呼び出し用の共有HTTPクライアント（コネクションプール）とキャッシュ用のRedisクライアントを作成する
+    """
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            max_connections=settings.HTTP_MAX_CONNECTIONS
+        ),
+        timeout=settings.HTTP_TIMEOUT
+    )
+    jancode_service.http_client = app.state.http
+    openai_service.init_client(app.state.http)
+    
+    # REDIS_URLが設定されている場合はキャッシュをワーカー間・再起動後も共有する
+    app.state.redis = Redis.from_url(
+        settings.REDIS_URL,
+        socket_connect_timeout=settings.REDIS_TIMEOUT,
+        socket_timeout=settings.REDIS_TIMEOUT
+    ) if settings.REDIS_URL else None
+    set_redis_client(app.state.redis)
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    共有HTTPクライアントとRedisクライアントを閉じる
+    """
+    await app.state.http.aclose()
+    if app.state.redis:
+        set_redis_client(None)
+        await app.state.redis.aclose()
+
 # APIルーターの登録
 app.include_router(api_router, prefix=settings.API_V1_STR)
 
 # エラーハンドラー
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={"detail": exc.detail},
     )
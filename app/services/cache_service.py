@@ -0,0 +1,119 @@
+"""
+推定結果や外部APIレスポンスのキャッシュを行うサービス
+"""
+import time
+from typing import Any, Optional
+import orjson
+import zstandard
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+
+# 全キャッシュで共有するRedisクライアント（アプリケーション起動時に設定、未設定の場合はインメモリのみ）
+_redis: Optional[Redis] = None
+# Redisでエラーが発生した場合、この時刻（time.monotonic()）まではRedisを使わない
+_redis_retry_at: float = 0.0
+
+# Redisに保存する値の圧縮・展開
+_compressor = zstandard.ZstdCompressor()
+_decompressor = zstandard.ZstdDecompressor()
+
+def set_redis_client(redis_client: Optional[Redis]) -> None:
+    """
+    キャッシュの2層目として使用するRedisクライアントを設定する
+    
+    Args:
+        redis_client: Redisクライアント（Noneの場合はインメモリのキャッシュのみ使用）
+    """
+    global _redis, _redis_retry_at
+    _redis = redis_client
+    _redis_retry_at = 0.0
+
+def _get_redis() -> Optional[Redis]:
+    """
+    使用可能なRedisクライアントを取得する
+    
+    Returns:
+        Optional[Redis]: Redisクライアント（未設定、またはエラー後の待機期間中の場合はNone）
+    """
+    if _redis is None or time.monotonic() < _redis_retry_at:
+        return None
+    return _redis
+
+def _mark_redis_failed() -> None:
+    """Redisでエラーが発生したことを記録し、一定期間Redisを使わないようにする"""
+    global _redis_retry_at
+    _redis_retry_at = time.monotonic() + settings.REDIS_RETRY_INTERVAL
+
+class AsyncTTLCache:
+    """TTL付きのキャッシュ（インメモリ → Redisの2層、名前空間ごとにキーを分割する）"""
+    
+    def __init__(self, namespace: str, maxsize: int, ttl: int):
+        self.namespace = namespace
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+    
+    def make_key(self, *parts: str) -> str:
+        """
+        名前空間を付与したキャッシュキーを作成する
+        
+        Args:
+            parts: キーを構成する文字列
+            
+        Returns:
+            str: キャッシュキー
+        """
+        return "|".join((self.namespace,) + parts)
+    
+    async def get(self, key: str) -> Optional[Any]:
+        """
+        キャッシュから値を取得する（インメモリになければRedisを参照する）
+        
+        Args:
+            key: キャッシュキー
+            
+        Returns:
+            Optional[Any]: キャッシュされた値（存在しない場合はNone）
+        """
+        value = self._cache.get(key)
+        redis_client = _get_redis()
+        if value is not None or redis_client is None:
+            return value
+        
+        try:
+            data = await redis_client.get(key)
+        except RedisError:
+            # Redisに接続できない場合はキャッシュなしとして扱い、しばらくRedisへの問い合わせを止める
+            _mark_redis_failed()
+            return None
+        if data is None:
+            return None
+        
+        try:
+            value = orjson.loads(_decompressor.decompress(data))
+        except (zstandard.ZstdError, orjson.JSONDecodeError):
+            # 破損した値や他の形式で保存された値はキャッシュなしとして扱う
+            return None
+        self._cache[key] = value
+        return value
+    
+    async def set(self, key: str, value: Any) -> None:
+        """
+        キャッシュに値を保存する（Redisが設定されている場合はRedisにも保存する）
+        
+        Args:
+            key: キャッシュキー
+            value: 保存する値（JSONに変換可能な値）
+        """
+        self._cache[key] = value
+        redis_client = _get_redis()
+        if redis_client is None:
+            return
+        
+        try:
+            await redis_client.set(key, _compressor.compress(orjson.dumps(value)), ex=self.ttl)
+        except RedisError:
+            # Redisへの保存に失敗してもインメモリのキャッシュは有効（しばらくRedisへの保存を止める）
+            _mark_redis_failed()
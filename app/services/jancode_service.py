@@ -1,16 +1,26 @@
 """
 JANCODE LOOKUP APIとの連携を行うサービス
 """
+import asyncio
 import httpx
-from urllib.parse import urlencode
+from typing import Dict, List, Optional
 from app.core.config import settings
+from app.services.cache_service import AsyncTTLCache
 
 class JANCodeLookupService:
     """JANCODE LOOKUP APIを利用して商品情報を検索するサービス"""
     
-    def __init__(self):
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
         self.base_url = settings.JANCODE_API_URL
         self.app_id = settings.JANCODE_API_APP_ID
+        # アプリケーション起動時に共有のHTTPクライアントが設定される
+        self.http_client = http_client
+        # キーワード検索結果のキャッシュ
+        self.keyword_cache = AsyncTTLCache(
+            namespace="jancode:keyword",
+            maxsize=settings.KEYWORD_SEARCH_CACHE_MAXSIZE,
+            ttl=settings.KEYWORD_SEARCH_CACHE_TTL
+        )
         
     async def search_by_keyword(self, keyword: str, hits: int = 5, page: int = 1) -> dict:
         """
@@ -24,6 +34,12 @@ class JANCodeLookupService:
         Returns:
             dict: 検索結果
         """
+        # 同一条件の検索結果がキャッシュにあればAPIを呼び出さない
+        cache_key = self.keyword_cache.make_key(keyword, str(hits), str(page))
+        cached_result = await self.keyword_cache.get(cache_key)
+        if cached_result is not None:
+            return cached_result
+        
         params = {
             'appId': self.app_id,
             'query': keyword,
@@ -32,12 +48,37 @@ class JANCodeLookupService:
             'type': 'keyword'
         }
         
-        url = f"{self.base_url}?{urlencode(params)}"
+        response = await self.http_client.get(self.base_url, params=params)
+        response.raise_for_status()
+        result = response.json()
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            return response.json()
+        await self.keyword_cache.set(cache_key, result)
+        return result
+    
+    async def search_by_keywords(self, keywords: List[str], hits: int = 5, page: int = 1) -> Dict[str, dict]:
+        """
+        複数のキーワードによる商品検索をまとめて行う
+        
+        JANCODE LOOKUP APIは複数キーワードの一括検索に対応していない（スペース区切りはAND検索）ため、
+        キーワードごとの検索を並列に実行する
+        
+        Args:
+            keywords: 検索キーワードのリスト（重複は呼び出し側で除外しておくこと）
+            hits: 各キーワードの取得件数（デフォルト: 5）
+            page: 取得ページ（デフォルト: 1）
+            
+        Returns:
+            Dict[str, dict]: キーワードごとの検索結果（キーワードの順序を維持、検索に失敗したキーワードは空の辞書）
+        """
+        results = await asyncio.gather(
+            *[self.search_by_keyword(keyword=keyword, hits=hits, page=page) for keyword in keywords],
+            return_exceptions=True
+        )
+        
+        return {
+            keyword: {} if isinstance(result, Exception) else result
+            for keyword, result in zip(keywords, results)
+        }
     
     async def search_by_code(self, code: str) -> dict:
         """
@@ -58,12 +99,9 @@ class JANCodeLookupService:
             'type': 'code'
         }
         
-        url = f"{self.base_url}?{urlencode(params)}"
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            return response.json()
+        response = await self.http_client.get(self.base_url, params=params)
+        response.raise_for_status()
+        return response.json()
     
     async def get_product_info(self, jancode: str) -> dict:
         """
@@ -1,43 +1,178 @@
 """
 OpenAI APIとの連携を行うサービス
 """
+import asyncio
 import base64
-import json
+import hashlib
+import io
+import re
 import httpx
-from typing import List, Optional, Dict, Any
-from openai import AsyncOpenAI
+import orjson
+from typing import List, Optional, Dict, Any, Tuple
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError
+)
+from PIL import Image, ImageOps
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from app.core.config import settings
+from app.services.cache_service import AsyncTTLCache
+
+# JANコード（13桁の数字）の抽出パターン
+_JANCODE_RE = re.compile(r'\b\d{13}\b')
+
+# 再試行の対象とする一時的なエラー（レート制限・接続エラー・タイムアウト・5xx）
+_RETRYABLE_OPENAI_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+def _resize_image(image_data: bytes) -> bytes:
+    """
+    画像を縮小してJPEGに再エンコードする
+    
+    Args:
+        image_data: 元の画像データ
+        
+    Returns:
+        bytes: 縮小後のJPEG画像データ（既に十分小さいJPEGや、縮小に失敗した場合は元のデータ）
+    """
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        # 既に十分小さいJPEGは、再エンコードでバーコードの数字が劣化しないようそのまま使う
+        if image.format == "JPEG" and max(image.size) <= settings.IMAGE_MAX_SIZE:
+            return image_data
+        
+        # EXIFの回転情報を反映してから縮小する
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        image.thumbnail((settings.IMAGE_MAX_SIZE, settings.IMAGE_MAX_SIZE))
+        
+        # 透過部分が黒にならないよう、白背景に合成してからJPEGにする
+        if has_alpha:
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=settings.IMAGE_JPEG_QUALITY, optimize=True)
+        return buffer.getvalue()
+    except Exception:
+        # Pillowは壊れた画像に対してValueError等も送出するため、縮小できない場合は元の画像をそのまま使う
+        return image_data
+
+def _encode_image(image_data: bytes) -> str:
+    """
+    画像を縮小してBase64エンコードする（CPU負荷が高いためスレッドで実行する）
+    
+    Args:
+        image_data: 元の画像データ
+        
+    Returns:
+        str: Base64エンコードされた縮小後の画像データ
+    """
+    return base64.b64encode(_resize_image(image_data)).decode('utf-8')
 
 class OpenAIService:
     """OpenAI APIを利用して画像分析や商品情報の推定を行うサービス"""
     
-    def __init__(self):
-        self.client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        # アプリケーション起動時に共有のHTTPクライアントが設定される
+        self.http_client: Optional[httpx.AsyncClient] = None
+        self.client: Optional[AsyncOpenAI] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # キーワード生成・候補絞り込み結果のキャッシュ（モデルの変更時に無効化されるようモデル名で分割）
+        self.keywords_cache = AsyncTTLCache(
+            namespace=f"oai:{settings.OPENAI_MODEL}:keywords",
+            maxsize=settings.OPENAI_CACHE_MAXSIZE,
+            ttl=settings.OPENAI_CACHE_TTL
+        )
+        self.filter_cache = AsyncTTLCache(
+            namespace=f"oai:{settings.OPENAI_MODEL}:filter",
+            maxsize=settings.OPENAI_CACHE_MAXSIZE,
+            ttl=settings.OPENAI_CACHE_TTL
+        )
+        if http_client is not None:
+            self.init_client(http_client)
+    
+    def init_client(self, http_client: httpx.AsyncClient) -> None:
+        """
+        共有のHTTPクライアントを設定し、同じコネクションプールを使うOpenAIクライアントを作成する
+        
+        Args:
+            http_client: アプリケーション全体で共有するHTTPクライアント
+        """
+        self.http_client = http_client
+        # 共有クライアントのタイムアウトは画像分析には短いため、OpenAI用に別途指定する
+        # 再試行はセマフォの外で待機する_create_chat_completionに任せるため、SDKの再試行は無効化する
+        self.client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            http_client=http_client,
+            timeout=settings.OPENAI_TIMEOUT,
+            max_retries=0
+        )
+        # レート制限を超えないよう、OpenAI APIへの同時リクエスト数を制限する
+        self._semaphore = asyncio.Semaphore(settings.MAX_OPENAI_CONCURRENCY)
+    
+    @retry(
+        retry=retry_if_exception_type(_RETRYABLE_OPENAI_ERRORS),
+        wait=wait_exponential_jitter(max=10),
+        stop=stop_after_attempt(settings.OPENAI_RETRY_ATTEMPTS),
+        reraise=True
+    )
+    async def _create_chat_completion(self, **kwargs):
+        """
+        同時リクエスト数を制限してChat Completions APIを呼び出す（一時的なエラー時は待機して再試行）
+        
+        Args:
+            kwargs: chat.completions.createに渡す引数
+            
+        Returns:
+            ChatCompletion: APIのレスポンス
+        """
+        async with self._semaphore:
+            return await self.client.chat.completions.create(**kwargs)
+    
+    async def fetch_image_base64(self, image_url: str) -> str:
+        """
+        商品画像をダウンロードし、縮小してBase64エンコードする
+        
+        Args:
+            image_url: 商品画像のURL
+            
+        Returns:
+            str: Base64エンコードされた画像データ
+        """
+        response = await self.http_client.get(image_url)
+        response.raise_for_status()
+        
+        # 縮小とBase64エンコードはイベントループを止めないよう別スレッドでまとめて実行する
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _encode_image, response.content)
     
-    async def analyze_product_image(self, image_url: str, product_name: str) -> List[str]:
+    async def analyze_product_image(self,
+                                    image_url: str,
+                                    product_name: str,
+                                    image_b64: Optional[str] = None) -> List[str]:
         """
         商品画像を分析し、JANコードの候補を推定する
         
         Args:
             image_url: 商品画像のURL
             product_name: 商品名
+            image_b64: Base64エンコード済みの商品画像（指定時はダウンロードを省略）
             
         Returns:
             List[str]: 推定されたJANコードの候補リスト
         """
         try:
-            # 画像URLから画像をダウンロード
-            async with httpx.AsyncClient() as client:
-                response = await client.get(image_url)
-                response.raise_for_status()
-                image_data = response.content
-            
-            # 画像をBase64エンコード
-            base64_image = base64.b64encode(image_data).decode('utf-8')
+            # 事前にエンコード済みの画像がなければダウンロードしてBase64エンコード
+            base64_image = image_b64 or await self.fetch_image_base64(image_url)
             
             # GPT-4 Visionを使用して画像分析
-            response = await self.client.chat.completions.create(
-                model="gpt-4o-mini",  # gpt-4o-miniモデルを使用
+            response = await self._create_chat_completion(
+                model=settings.OPENAI_MODEL,
                 messages=[
                     {
                         "role": "system",
@@ -45,9 +180,9 @@ class OpenAIService:
                         あなたは商品画像からJANコード（GTIN-13）を識別する専門家です。
                         JANコードは通常、商品のパッケージに印刷されたバーコードの下に13桁の数字で表示されています。
                         日本のJANコードは通常、45または49から始まります。
-                        画像からJANコードが見つかった場合は、そのコードのみを返してください。
+                        画像からJANコードが読み取れた場合は、そのコードのみを返してください。
                         複数の候補がある場合は、最も可能性の高いものから順に最大5つまで返してください。
-                        JANコードが見つからない場合は、商品名から推測される可能性のあるJANコードの特徴（メーカーコードなど）を返してください。
+                        画像からJANコードが読み取れない場合は、推測したコードは返さず「なし」とだけ返してください。
                         """
                     },
                     {
@@ -86,7 +221,7 @@ class OpenAIService:
         Returns:
             List[str]: 推定されたJANコードの候補リスト
         """
-        response = await self.client.chat.completions.create(
+        response = await self._create_chat_completion(
             model="gpt-4-turbo",
             messages=[
                 {
@@ -110,30 +245,38 @@ class OpenAIService:
         content = response.choices[0].message.content
         return self._extract_jancodes(content)
     
-    async def generate_search_keywords(self, image_url: str, product_name: str) -> List[str]:
+    async def generate_search_keywords(self,
+                                       image_url: str,
+                                       product_name: str,
+                                       image_b64: Optional[str] = None,
+                                       image_hash: Optional[str] = None) -> Tuple[List[str], str]:
         """
-        商品画像と商品名から検索キーワード候補を生成する
+        商品画像と商品名から検索キーワード候補と商品の外観の説明を生成する
         
         Args:
             image_url: 商品画像のURL
             product_name: 商品名
+            image_b64: Base64エンコード済みの商品画像（指定時はダウンロードを省略）
+            image_hash: image_b64のSHA-256ハッシュ（指定時は再計算を省略）
             
         Returns:
-            List[str]: 検索キーワード候補のリスト（最大5つ）
+            Tuple[List[str], str]: 検索キーワード候補のリスト（最大5つ）と商品の外観の説明
         """
         try:
-            # 画像URLから画像をダウンロード
-            async with httpx.AsyncClient() as client:
-                response = await client.get(image_url)
-                response.raise_for_status()
-                image_data = response.content
+            # 事前にエンコード済みの画像がなければダウンロードしてBase64エンコード
+            base64_image = image_b64 or await self.fetch_image_base64(image_url)
             
-            # 画像をBase64エンコード
-            base64_image = base64.b64encode(image_data).decode('utf-8')
+            # 同一の画像と商品名に対する生成結果がキャッシュにあればAPIを呼び出さない
+            if not (image_b64 and image_hash):
+                image_hash = hashlib.sha256(base64_image.encode()).hexdigest()
+            cache_key = self.keywords_cache.make_key(image_hash, product_name)
+            cached_result = await self.keywords_cache.get(cache_key)
+            if cached_result is not None:
+                return cached_result["keywords"], cached_result["visual_description"]
             
             # GPT-4 Visionを使用して画像分析
-            response = await self.client.chat.completions.create(
-                model="gpt-4o-mini",
+            response = await self._create_chat_completion(
+                model=settings.OPENAI_MODEL,
                 messages=[
                     {
                         "role": "system",
@@ -141,9 +284,11 @@ class OpenAIService:
                         あなたは商品画像と商品名から、JANコード検索に最適なキーワードを生成する専門家です。
                         商品の特徴（ブランド名、メーカー名、商品名、型番など）を抽出し、検索キーワードとして最適な形に整形してください。
                         複数の検索キーワード候補を生成し、最も検索に有効と思われるものから順に最大5つまで返してください。
+                        また、後で商品候補を絞り込めるよう、画像から読み取れる商品の特徴（パッケージの色・形状、容量、表記されている文字など）を簡潔に説明してください。
                         返答は以下のJSON形式で返してください：
                         {
-                          "keywords": ["キーワード1", "キーワード2", "キーワード3", "キーワード4", "キーワード5"]
+                          "keywords": ["キーワード1", "キーワード2", "キーワード3", "キーワード4", "キーワード5"],
+                          "visual_description": "商品の外観の説明"
                         }
                         """
                     },
@@ -169,33 +314,46 @@ class OpenAIService:
             
             # レスポンスからキーワード候補を抽出
             content = response.choices[0].message.content
-            data = json.loads(content)
+            data = orjson.loads(content)
             keywords = data.get("keywords", [])
+            # モデルがnullや文字列以外を返した場合も文字列として扱う
+            visual_description = data.get("visual_description") or ""
+            if not isinstance(visual_description, str):
+                visual_description = str(visual_description)
             
-            # 空のキーワードを除外
-            keywords = [k for k in keywords if k.strip()]
+            # 空のキーワードや文字列以外のキーワードを除外
+            keywords = [k for k in keywords or [] if isinstance(k, str) and k.strip()]
             
             # 商品名も検索キーワードに追加（まだリストにない場合）
             if product_name and product_name not in keywords:
                 keywords.append(product_name)
                 
-            return keywords[:5]  # 最大5つまでに制限
+            keywords = keywords[:5]  # 最大5つまでに制限
             
-        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            await self.keywords_cache.set(cache_key, {
+                "keywords": keywords,
+                "visual_description": visual_description
+            })
+            return keywords, visual_description
+            
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
             # エラーが発生した場合は商品名のみを返す
-            return [product_name] if product_name else []
+            return ([product_name] if product_name else []), ""
     
     async def filter_jancode_candidates(self,
                                        jancode_candidates: List[Dict[str, Any]],
                                        product_name: str,
-                                       image_url: str) -> List[str]:
+                                       visual_description: str = "") -> List[str]:
         """
         JANコード候補リストから最適な候補を選択する
         
+        画像は検索キーワード生成時に分析済みのため再送せず、その際に得た外観の説明を使って
+        テキストのみで絞り込む
+        
         Args:
             jancode_candidates: JANコード候補のリスト（JANCODE LOOKUP APIのレスポンス）
             product_name: 商品名
-            image_url: 商品画像のURL
+            visual_description: 商品の外観の説明（generate_search_keywordsの結果）
             
         Returns:
             List[str]: 絞り込まれたJANコード候補のリスト（最大5つ）
@@ -203,32 +361,34 @@ class OpenAIService:
                  APIルートでこれらのJANコードを使って商品情報を取得します
         """
         try:
-            # 画像URLから画像をダウンロード
-            async with httpx.AsyncClient() as client:
-                response = await client.get(image_url)
-                response.raise_for_status()
-                image_data = response.content
-            
-            # 画像をBase64エンコード
-            base64_image = base64.b64encode(image_data).decode('utf-8')
-            
             # 候補がない場合は空のリストを返す
             if not jancode_candidates:
                 return []
             
+            # 同一の商品名・外観・候補に対する絞り込み結果がキャッシュにあればAPIを呼び出さない
+            codes = sorted(str(candidate.get("codeNumber") or "") for candidate in jancode_candidates)
+            cache_source = "|".join([product_name, visual_description] + codes)
+            cache_key = self.filter_cache.make_key(hashlib.sha256(cache_source.encode()).hexdigest())
+            cached_result = await self.filter_cache.get(cache_key)
+            if cached_result is not None:
+                return cached_result
+            
             # JANコード候補をJSON文字列に変換
-            candidates_json = json.dumps(jancode_candidates, ensure_ascii=False, indent=2)
+            candidates_json = orjson.dumps(jancode_candidates, option=orjson.OPT_INDENT_2).decode()
+            
+            # 商品の外観の説明（取得できなかった場合は商品名のみで判断）
+            description_text = f"\n商品の外観：{visual_description}" if visual_description else ""
             
-            # GPT-4 Visionを使用して候補を絞り込む
-            response = await self.client.chat.completions.create(
-                model="gpt-4o-mini",
+            # テキストのみで候補を絞り込む（画像は再送しない）
+            response = await self._create_chat_completion(
+                model=settings.OPENAI_MODEL,
                 messages=[
                     {
                         "role": "system",
                         "content": """
-                        あなたは商品画像と商品名から、最適なJANコード候補を選択する専門家です。
-                        提供されたJANコード候補リストから、商品画像と商品名に最も一致する候補を選択してください。
-                        商品名、ブランド名、メーカー名、商品画像の特徴などを総合的に判断し、最も可能性の高いJANコードを選んでください。
+                        あなたは商品名と商品の外観の説明から、最適なJANコード候補を選択する専門家です。
+                        提供されたJANコード候補リストから、商品名と商品の外観に最も一致する候補を選択してください。
+                        商品名、ブランド名、メーカー名、外観の特徴などを総合的に判断し、最も可能性の高いJANコードを選んでください。
                         返答は以下のJSON形式で返してください：
                         {
                           "jancodes": ["4901234567890", "4902345678901", "4903456789012"]
@@ -237,18 +397,7 @@ class OpenAIService:
                     },
                     {
                         "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f"この商品画像と商品名「{product_name}」に最も一致するJANコードを、以下の候補から選んでください：\n\n{candidates_json}"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
+                        "content": f"商品名「{product_name}」に最も一致するJANコードを、以下の候補から選んでください：{description_text}\n\n{candidates_json}"
                     }
                 ],
                 max_tokens=500,
@@ -257,14 +406,16 @@ class OpenAIService:
             
             # レスポンスからJANコード候補を抽出
             content = response.choices[0].message.content
-            data = json.loads(content)
+            data = orjson.loads(content)
             jancodes = data.get("jancodes", [])
             
             # 重複を削除し、最大5つまでに制限
-            unique_jancodes = list(dict.fromkeys(jancodes))
-            return unique_jancodes[:settings.MAX_CANDIDATES]
+            unique_jancodes = list(dict.fromkeys(jancodes))[:settings.MAX_CANDIDATES]
             
-        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            await self.filter_cache.set(cache_key, unique_jancodes)
+            return unique_jancodes
+            
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
             # エラーが発生した場合は元の候補をそのまま返す
             return [candidate.get("codeNumber") for candidate in jancode_candidates
                    if candidate.get("codeNumber")][:settings.MAX_CANDIDATES]
@@ -279,15 +430,8 @@ class OpenAIService:
         Returns:
             List[str]: 抽出されたJANコードのリスト
         """
-        import re
-        
-        # 13桁の数字を抽出
-        jancode_pattern = r'\b\d{13}\b'
-        jancodes = re.findall(jancode_pattern, text)
-        
-        # 重複を削除し、最大5つまでに制限
-        unique_jancodes = list(dict.fromkeys(jancodes))
-        return unique_jancodes[:settings.MAX_CANDIDATES]
+        # 13桁の数字を抽出し、重複を削除して最大5つまでに制限
+        return list(dict.fromkeys(_JANCODE_RE.findall(text)))[:settings.MAX_CANDIDATES]
 
 # サービスのインスタンスを作成
 openai_service = OpenAIService()
\ No newline at end of file
@@ -1,7 +1,12 @@
 """
 JANコード（GTIN）に関するユーティリティ関数
 """
+from functools import lru_cache
 
+# チェックディジット計算用の重み（先頭12桁、0から始まる偶数位置は1、奇数位置は3）
+_CHECK_DIGIT_WEIGHTS = (1, 3, 1, 3, 1, 3, 1, 3, 1, 3, 1, 3)
+
+@lru_cache(maxsize=4096)
 def validate_jancode(jancode: str) -> bool:
     """
     JANコード（GTIN-13）の検証を行う
@@ -16,17 +21,12 @@ def validate_jancode(jancode: str) -> bool:
         return False
     
     # チェックディジットの計算
-    total = 0
-    for i in range(12):
-        digit = int(jancode[i])
-        if i % 2 == 0:  # 偶数位置（0から始まる）
-            total += digit
-        else:  # 奇数位置
-            total += digit * 3
+    total = sum(int(c) * w for c, w in zip(jancode, _CHECK_DIGIT_WEIGHTS))
     
     check_digit = (10 - (total % 10)) % 10
     return check_digit == int(jancode[12])
 
+@lru_cache(maxsize=4096)
 def format_jancode(jancode: str) -> str:
     """
     JANコードを正規化する（スペースや記号を削除し、数字のみにする）
@@ -40,6 +40,7 @@ def format_jancode(jancode: str) -> str:
     # 数字以外の文字を削除
     return ''.join(c for c in jancode if c.isdigit())
 
+@lru_cache(maxsize=4096)
 def get_country_code(jancode: str) -> str:
     """
     JANコードから国コードを取得する